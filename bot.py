@@ -3,53 +3,85 @@ Main entry point for the JDownloader 2 Telegram Bot.
 This module handles Telegram event registration and authentication.
 """
 import os
+import re
+import queue
+import atexit
 import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlsplit, parse_qsl, urlencode
 from dotenv import load_dotenv
 from pyrogram import Client, filters
 from pyrogram.errors import MessageNotModified
 
-from jd_client import get_jd_client
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from jd_client import get_async_jd_client
 from bot_logic import (
-    user_sessions, jd_toggle_states, jd_linkgrabber_cache,
-    user_pagination, active_scans, executor, process_jd_links,
-    monitor_jd_downloads, get_jd_toggle_keyboard
+    get_user_state, process_jd_links, monitor_jd_downloads, get_jd_toggle_keyboard,
+    get_cached_media, send_cached_media, media_cache_key, MAX_CONCURRENT_UPLOADS, TOGGLE_EDIT_DEBOUNCE
 )
 
 # Load environment variables
 load_dotenv()
 
-# Logger setup
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+# Logger setup: records are queued and written to stderr by a listener thread,
+# so logging never blocks the event loop on console I/O
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+logging.root.addHandler(QueueHandler(_log_queue))
+logging.root.setLevel(logging.INFO)
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+def _parse_ids(name: str) -> frozenset:
+    """Parse a comma-separated list of Telegram user ids from the environment."""
+    tokens = (token.strip() for token in os.getenv(name, "").split(","))
+    return frozenset(int(token) for token in tokens if token)
+
 # Constants
 API_ID = int(os.getenv("API_ID"))
 API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = [int(i.strip()) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()]
-USER_IDS = [int(i.strip()) for i in os.getenv("USER_IDS", "").split(",") if i.strip()]
-AUTHORIZED_USERS = set(ADMIN_IDS + USER_IDS)
+ADMIN_IDS = _parse_ids("ADMIN_IDS")
+USER_IDS = _parse_ids("USER_IDS")
+AUTHORIZED_USERS = ADMIN_IDS | USER_IDS
+
+# uvloop must be installed before the Client below binds its event loop
+if uvloop is not None:
+    uvloop.install()
 
 # Initialize Pyrogram Client
 app = Client(
     "siphon_bot",
     api_id=API_ID,
     api_hash=API_HASH,
-    bot_token=BOT_TOKEN
+    bot_token=BOT_TOKEN,
+    # Pyrogram serialises save_file calls to 1 by default, which would queue the
+    # session's parallel uploads behind each other; big files already fan out
+    # their parts over several upload sessions inside each transmission.
+    max_concurrent_transmissions=MAX_CONCURRENT_UPLOADS,
+    # A link scan keeps its handler busy for up to 30s of LinkGrabber polling;
+    # enough workers that callbacks from other users are not queued behind it
+    workers=16
 )
 
 # Check for JD availability
 JD_AVAILABLE = bool(os.getenv("JD_EMAIL") and os.getenv("JD_PASSWORD"))
 
 # Authorization Filter
-async def is_authorized(_client, _query, message):
+# Kept as a coroutine: Pyrogram runs plain-function filters on its thread executor.
+async def is_authorized(_client, _query, update):
     """Filter to check if a user is authorized."""
-    user_id = message.from_user.id if message.from_user else None
-    return user_id in AUTHORIZED_USERS
+    return update.from_user is not None and update.from_user.id in AUTHORIZED_USERS
 
 auth_filter = filters.create(is_authorized)
 
@@ -63,140 +95,221 @@ async def start_command(_client, message):  # vulture: ignore
         "Send me a link to scan and download files."
     )
 
+# Any scheme JDownloader can crawl (http, https, ftp, ...), up to the next whitespace
+URL_PATTERN = re.compile(r"\b[a-z][a-z0-9+.-]*://\S+", re.IGNORECASE)
+# Sentence punctuation that \S+ swallows after a URL ("see https://a.com/x, and ...")
+URL_TRAILING_PUNCTUATION = ".,;:!?)]}>'\""
+URL_CLOSING_BRACKETS = {")": "(", "]": "[", "}": "{"}
+
+def _trim_url(url: str) -> str:
+    """Strip trailing punctuation, keeping closing brackets that pair with one in the URL."""
+    while url and url[-1] in URL_TRAILING_PUNCTUATION:
+        opener = URL_CLOSING_BRACKETS.get(url[-1])
+        if opener and url.count(opener) >= url.count(url[-1]):
+            break  # Balanced, e.g. https://en.wikipedia.org/wiki/Foo_(bar)
+        url = url[:-1]
+    return url
+TRACKING_PARAMS = frozenset({"fbclid", "gclid", "igshid"})
+
+def _unique_urls(urls):
+    """Drop URLs that differ from an earlier one only by tracking parameters."""
+    unique = {}
+    for url in urls:
+        parts = urlsplit(url)
+        query = urlencode(sorted(
+            (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+            if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS
+        ))
+        # Hosts like MEGA carry the file id and key in the fragment
+        key = (parts.scheme.lower(), parts.netloc.lower(), parts.path, query, parts.fragment)
+        unique.setdefault(key, url)
+    return list(unique.values())
+
 @app.on_message(filters.text & auth_filter & ~filters.command(["start", "help", "settings"]))
 async def handle_message(client, message):  # vulture: ignore
     """Handle incoming text messages (links)."""
     user_id = message.from_user.id
-    text = message.text.strip()
 
     if not JD_AVAILABLE:
         await message.reply_text("❌ JDownloader 2 not configured.")
         return
 
-    # Extract URL (Simple regex or basic string check)
-    if "://" in text:
-        urls = [text] # Simplified
+    # Each URL costs a LinkGrabber submission, so send every page only once
+    urls = _unique_urls(_trim_url(url) for url in URL_PATTERN.findall(message.text))
+    if urls:
         msg = await message.reply_text("🔍 **Processing link...**")
         await process_jd_links(client, user_id, msg, urls)
     else:
         await message.reply_text("❓ Please send a valid link.")
 
-@app.on_callback_query(auth_filter)
+# "<action>" or "<action>_<argument>" for the parameterised toggle/page buttons
+CALLBACK_PATTERN = re.compile(
+    r"^(?P<action>jd_toggle|jd_page|jd_[a-z_]+|scan_stop)(?:_(?P<arg>\w+))?$"
+)
+
+@app.on_callback_query(filters.regex(CALLBACK_PATTERN) & auth_filter)
 async def handle_callbacks(client, callback_query):  # vulture: ignore
-    """Handle callback queries."""
-    user_id = callback_query.from_user.id
-    data = callback_query.data
-
-    if data == "scan_stop":
-        active_scans[user_id] = False
-        # Optional: Call abort_crawling here too
-        jd = get_jd_client()
-        await asyncio.get_event_loop().run_in_executor(executor, jd.abort_crawling)
-        await callback_query.answer("🛑 Stopping scan...")
+    """Route callback queries through the dispatch table below."""
+    # The regex filter already matched the data; reuse its match object
+    action, arg = callback_query.matches[0].group("action", "arg")
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is not None:
+        await handler(client, callback_query.from_user.id, arg, callback_query)
+
+async def _handle_scan_stop(_client, user_id, _data, callback_query):
+    get_user_state(user_id).scanning = False
+    # Acknowledge before the JD round-trip; the scan loop exits on its next check
+    await callback_query.answer("🛑 Stopping scan...")
+    await get_async_jd_client().abort_crawling()
+
+async def _handle_toggle(_client, user_id, uuid, callback_query):
+    ustate = get_user_state(user_id)
+    if ustate.toggle(uuid) is None:
+        # Button from a previous scan's keyboard; it must not leak into this selection
+        await callback_query.answer("⚠️ This list is out of date, send the link again.")
         return
+    # Coalesce a burst of toggles into a single edit of the final selection
+    ustate.cancel_keyboard_edit()
+    ustate.keyboard_edit = asyncio.create_task(_render_toggles_later(ustate, callback_query))
+    await callback_query.answer()
 
-    if data.startswith("jd_toggle_"):
-        await _handle_toggle(user_id, data, callback_query)
-    elif data.startswith("jd_page_"):
-        await _handle_pagination(user_id, data, callback_query)
-    elif data == "jd_select_all":
-        await _handle_bulk_select(user_id, callback_query, True)
-    elif data == "jd_deselect_all":
-        await _handle_bulk_select(user_id, callback_query, False)
-    elif data == "jd_refresh":
-        await callback_query.answer("🔄 Refreshing...")
-        await process_jd_links(client, user_id, callback_query.message, [], False)
-    elif data == "jd_cancel":
-        await _handle_cancel(user_id, callback_query)
-    elif data == "jd_confirm":
-        await _handle_confirm(client, user_id, callback_query)
-    elif data == "jd_cancel_active":
-        await _handle_cancel_active(user_id, callback_query)
-    elif data == "jd_noop":
-        await callback_query.answer()
-    elif data == "jd_add_more":
-        await callback_query.answer()
-        await _client.send_message(user_id, "🔗 כעת שלח אליי עוד קישורים, ואז לחץ על '🔄 רענון'.")
-
-async def _handle_toggle(user_id, data, callback_query):
-    uuid = data.replace("jd_toggle_", "")
-    toggles = jd_toggle_states.get(user_id, {})
-    toggles[uuid] = not toggles.get(uuid, True)
-    jd_toggle_states[user_id] = toggles
-    links = jd_linkgrabber_cache.get(user_id, [])
-    page = user_pagination.get(user_id, 0)
+async def _render_toggles_later(ustate, callback_query):
+    await asyncio.sleep(TOGGLE_EDIT_DEBOUNCE)
     try:
-        await callback_query.edit_message_reply_markup(
-            get_jd_toggle_keyboard(user_id, links, page)
-        )
+        await callback_query.edit_message_reply_markup(get_jd_toggle_keyboard(ustate))
     except MessageNotModified:
         pass
-    await callback_query.answer()
+    except Exception as err:  # pylint: disable=broad-except
+        logger.error("Toggle keyboard edit failed: %s", err)
 
-async def _handle_pagination(user_id, data, callback_query):
-    page = int(data.split("_")[2])
-    user_pagination[user_id] = page
-    links = jd_linkgrabber_cache.get(user_id, [])
+async def _handle_pagination(_client, user_id, page, callback_query):
+    ustate = get_user_state(user_id)
+    previous_page = ustate.page
+    changed = ustate.set_page(int(page))
+    # Answer before the edit so the button spinner clears without waiting on it
+    await callback_query.answer()
+    if not changed:
+        # Same page as on screen; Telegram would reject the edit anyway
+        return
     try:
-        await callback_query.edit_message_reply_markup(
-            get_jd_toggle_keyboard(user_id, links, page)
-        )
+        await callback_query.edit_message_reply_markup(get_jd_toggle_keyboard(ustate))
     except MessageNotModified:
         pass
-    await callback_query.answer()
+    except Exception as err:  # pylint: disable=broad-except
+        # The keyboard still shows the old page; keep the state in step with it
+        ustate.page = previous_page
+        logger.error("Pagination edit failed: %s", err)
 
 async def _handle_bulk_select(user_id, callback_query, select_all):
-    links = jd_linkgrabber_cache.get(user_id, [])
-    jd_toggle_states[user_id] = {str(l['uuid']): select_all for l in links}
+    ustate = get_user_state(user_id)
+    changed = ustate.set_all(select_all)
+    await callback_query.answer("✅ All selected" if select_all else "❌ All deselected")
+    if not changed:
+        return
     try:
-        await callback_query.edit_message_reply_markup(
-            get_jd_toggle_keyboard(user_id, links, user_pagination.get(user_id, 0))
-        )
+        await callback_query.edit_message_reply_markup(get_jd_toggle_keyboard(ustate))
     except MessageNotModified:
         pass
-    await callback_query.answer("✅ All selected" if select_all else "❌ All deselected")
 
-async def _handle_cancel(user_id, callback_query):
-    jd_linkgrabber_cache.pop(user_id, None)
-    jd_toggle_states.pop(user_id, None)
+async def _handle_select_all(_client, user_id, _data, callback_query):
+    await _handle_bulk_select(user_id, callback_query, True)
+
+async def _handle_deselect_all(_client, user_id, _data, callback_query):
+    await _handle_bulk_select(user_id, callback_query, False)
+
+async def _handle_refresh(client, user_id, _data, callback_query):
+    ustate = get_user_state(user_id)
+    if ustate.scanning:
+        # A scan/refresh is already polling LinkGrabber; let it finish
+        await callback_query.answer("⏳ Already refreshing...")
+        return
+    # The scan takes over this message; a late toggle edit would replace its markup
+    ustate.cancel_keyboard_edit()
+    await callback_query.answer("🔄 Refreshing...")
+    await process_jd_links(client, user_id, callback_query.message, [], False)
+
+async def _handle_cancel(_client, user_id, _data, callback_query):
+    get_user_state(user_id).clear_links()
     try:
-        jd = get_jd_client()
-        await asyncio.get_event_loop().run_in_executor(executor, jd.clear_linkgrabber)
+        await get_async_jd_client().clear_linkgrabber()
     except Exception:  # pylint: disable=broad-except
         pass
     await callback_query.edit_message_text("❌ Session cancelled.")
 
-async def _handle_confirm(client, user_id, callback_query):
-    links = jd_linkgrabber_cache.get(user_id, [])
-    toggles = jd_toggle_states.get(user_id, {})
-    selected = [l['uuid'] for l in links if toggles.get(str(l['uuid']), True)]
-    if not selected:
+async def _handle_confirm(client, user_id, _data, callback_query):
+    ustate = get_user_state(user_id)
+    if not ustate.selected:
         await callback_query.answer("⚠️ Please select at least one file!", show_alert=True)
         return
+    ustate.cancel_keyboard_edit()
     await callback_query.edit_message_text("🚀 **Starting downloads...**")
 
-    # Actually move them to download list
-    jd = get_jd_client()
-    await asyncio.get_event_loop().run_in_executor(
-        executor, jd.move_to_downloads, selected
-    )
+    # Links uploaded before are re-sent by file_id instead of downloaded again
+    to_download = []
+    for link in ustate.links:
+        if link['uuid_key'] not in ustate.selected:
+            continue
+        cached = get_cached_media(media_cache_key(link))
+        if cached:
+            try:
+                await send_cached_media(client, user_id, cached)
+                continue
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning("Cached resend failed, downloading again: %s", err)
+        to_download.append(link)
 
-    asyncio.create_task(monitor_jd_downloads(client, user_id, callback_query.message, selected))
-    jd_linkgrabber_cache.pop(user_id, None)
-    jd_toggle_states.pop(user_id, None)
+    jd = get_async_jd_client()
+    if to_download:
+        # Actually move them to download list
+        selected = tuple(l['uuid'] for l in to_download)
+        await jd.move_to_downloads(list(selected))
+
+        media_keys = {l['uuid_key']: media_cache_key(l) for l in to_download}
+        status_msg = callback_query.message
+        # Referenced from the user state so the long-lived monitor can't be collected mid-run
+        task = asyncio.create_task(monitor_jd_downloads(
+            client, user_id, status_msg.chat.id, status_msg.id, selected, media_keys))
+        ustate.monitor_tasks.add(task)
+        task.add_done_callback(ustate.monitor_tasks.discard)
+    else:
+        await callback_query.edit_message_text("✅ **All files were sent from cache.**")
+    ustate.clear_links()
     # Clear linkgrabber in JD after moving links
     try:
-        await asyncio.get_event_loop().run_in_executor(executor, jd.clear_linkgrabber)
+        await jd.clear_linkgrabber()
     except Exception:  # pylint: disable=broad-except
         pass
 
-async def _handle_cancel_active(user_id, callback_query):
-    state = user_sessions.get(user_id)
+async def _handle_cancel_active(_client, user_id, _data, callback_query):
+    state = get_user_state(user_id).session
     if state:
         state.is_active = False
+        state.changed.set()
         await callback_query.answer("⏹️ Stopping session...", show_alert=True)
     else:
         await callback_query.answer("⚠️ No active session found.")
 
+async def _handle_noop(_client, _user_id, _data, callback_query):
+    await callback_query.answer()
+
+async def _handle_add_more(client, user_id, _data, callback_query):
+    await callback_query.answer()
+    await client.send_message(user_id, "🔗 כעת שלח אליי עוד קישורים, ואז לחץ על '🔄 רענון'.")
+
+# Keyed by the "action" group of CALLBACK_PATTERN
+CALLBACK_HANDLERS = {
+    "scan_stop": _handle_scan_stop,
+    "jd_toggle": _handle_toggle,
+    "jd_page": _handle_pagination,
+    "jd_select_all": _handle_select_all,
+    "jd_deselect_all": _handle_deselect_all,
+    "jd_refresh": _handle_refresh,
+    "jd_cancel": _handle_cancel,
+    "jd_confirm": _handle_confirm,
+    "jd_cancel_active": _handle_cancel_active,
+    "jd_noop": _handle_noop,
+    "jd_add_more": _handle_add_more,
+}
+
 if __name__ == "__main__":
     app.run()
@@ -6,28 +6,90 @@ import os
 import time
 import asyncio
 import logging
-from typing import Dict, List
+import functools
+from collections import OrderedDict
+from itertools import islice
 from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
 
+from pyrogram.errors import FloodWait
 from pyrogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     InputMediaPhoto
 )
 
-from jd_client import get_jd_client
+from jd_client import get_async_jd_client
 from utils import (
-    format_size, moon_progress_bar, get_video_metadata,
+    format_size, moon_progress_bar, get_video_metadata, get_video_duration,
     needs_conversion, convert_to_mp4, split_video
 )
 
 # Configuration & Logging
 logger = logging.getLogger(__name__)
-executor = ThreadPoolExecutor(max_workers=4)
 
-VIDEO_EXTENSIONS = {
+PAGE_SIZE = 8  # Links per selection keyboard page
+MAX_CONCURRENT_UPLOADS = 3  # Per session, to stay clear of Telegram flood limits
+FFMPEG_MAX_JOBS = max(2, (os.cpu_count() or 2) // 2)  # Bot-wide transcode/split/thumb jobs
+
+# Polling cadence (seconds)
+POLL_INTERVAL_ACTIVE = 3  # JD poll while something is transferring (>= dashboard spacing)
+POLL_INTERVAL_IDLE = 5  # JD poll while queued/stalled
+DASHBOARD_MIN_INTERVAL = 2.5  # Minimum spacing between dashboard renders
+DASHBOARD_IDLE_REFRESH = 5  # Re-check the dashboard even without a change signal
+FLOOD_WAIT_RETRIES = 3  # Attempts per media send when Telegram answers FloodWait
+ALBUM_CHUNK_DELAY = 3  # Seconds between consecutive albums
+ALBUM_SIZE = 10  # Telegram's media group limit
+ALBUM_IDLE_FLUSH = 5  # Send a partial album after this many seconds without a new image
+SCAN_POLL_DELAYS = (2, 2, 3, 4)  # LinkGrabber poll spacing, backing off while the count holds
+TOGGLE_EDIT_DEBOUNCE = 0.2  # Seconds of toggle quiet before the keyboard is re-rendered
+
+# Links whose uploaded file_ids are remembered; 0 always downloads afresh
+SENT_MEDIA_CACHE_SIZE = int(os.getenv("SENT_MEDIA_CACHE_SIZE", "500"))
+
+VIDEO_EXTENSIONS = frozenset({
     '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm',
     '.m4v', '.mpg', '.mpeg', '.3gp', '.ts'
-}
+})
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.webp'})  # Sent batched as albums
+
+# Dashboard templates
+SEP = "━" * 18
+DASHBOARD_HEADER = f"🚀 **מרכז בקרה - Siphon Bot**\n{SEP}\n\n"
+DOWNLOADS_TITLE = "📥 **בהורדה מ-JD2:**\n"
+DOWNLOAD_ITEM_TEMPLATE = "🔹 `{name}...`\n   {bar} {progress:.1f}%\n   └ ⚡ {speed}/s\n"
+QUEUED_TEMPLATE = "   _...ועוד {count} קבצים בתור_\n"
+PROCESSING_LINE = "⌛ מעבד נתונים ב-JDownloader...\n\n"
+UPLOADS_TITLE = "📤 **בהעלאה לטלגרם:**\n"
+UPLOAD_ITEM_TEMPLATE = "🔹 `{name}...`\n   {bar} {progress:.1f}%\n"
+DONE_TEMPLATE = "✅ **הסתיים!**\nקבצים שהושלמו: {count}\n"
+EMPTY_LINE = "🏁 כל המשימות הושלמו או שהתור ריק."
+ELAPSED_TEMPLATE = "⏱️ זמן שחלף: `{minutes}m {seconds}s`\n"
+
+# Callback data prefixes for parameterised buttons
+JD_TOGGLE_PREFIX = "jd_toggle_"
+JD_PAGE_PREFIX = "jd_page_"
+
+# Static keyboards, built once and shared by every render
+SELECTION_CONTROL_ROWS = (
+    [
+        InlineKeyboardButton("✨ בחר הכל", callback_data="jd_select_all"),
+        InlineKeyboardButton("🧹 בטל הכל", callback_data="jd_deselect_all")
+    ],
+    [
+        InlineKeyboardButton("🔄 רענון", callback_data="jd_refresh"),
+        InlineKeyboardButton("➕ הוסף קישורים", callback_data="jd_add_more")
+    ],
+    [
+        InlineKeyboardButton("🚀 התחל הורדה", callback_data="jd_confirm"),
+        InlineKeyboardButton("🗑️ ביטול", callback_data="jd_cancel")
+    ],
+)
+DASHBOARD_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛑 ביטול הורדה", callback_data="jd_cancel_active")]
+])
+SCAN_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("🛑 עצור וסנן", callback_data="scan_stop")
+]])
 
 # ============ Shared State ============
 
@@ -37,15 +99,160 @@ class SessionState:
     def __init__(self):
         self.is_active = True
         self.jd_downloads = []  # List of dicts from JD
+        self.active_downloads = []  # Unfinished subset of jd_downloads, set per poll
+        self.transferring = False  # Any active download had speed on the last poll
+        self.poll_snapshot = None  # Progress fields of the last JD poll, to detect changes
         self.active_uploads = {}  # {filename: percentage}
         self.completed_tasks = []  # List of filenames
+        self.pending_jd_removals = set()  # JD link UUIDs to remove on next poll
+        self.media_keys: Dict[str, tuple] = {}  # {link_uuid: media_cache_key} for re-sends
+        self.upload_sem = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)  # Concurrent transfers
+        self.upload_tasks = set()  # Running or queued upload/album tasks
+        self.dashboard_task = None
+        self.changed = asyncio.Event()  # Set whenever dashboard-visible state mutates
         self.start_time = time.time()
 
-user_sessions: Dict[int, SessionState] = {}
-jd_toggle_states: Dict[int, Dict[str, bool]] = {}  # {user_id: {link_uuid: bool}}
-jd_linkgrabber_cache: Dict[int, List[dict]] = {}  # {user_id: [links]}
-user_pagination: Dict[int, int] = {}  # {user_id: page_index}
-active_scans: Dict[int, bool] = {}  # {user_id: bool}
+# pylint: disable=too-few-public-methods
+class UserState:
+    """All per-user bot state, so handlers need a single lookup by user id."""
+    def __init__(self):
+        self.session: Optional[SessionState] = None  # Active download/upload session
+        self.scanning = False  # LinkGrabber scan in progress
+        self.links: List[dict] = []  # LinkGrabber results awaiting selection
+        self.selected: Set[str] = set()  # UUIDs of selected links
+        self.link_positions: Dict[str, int] = {}  # {link_uuid: index in links}
+        self.rendered_pages: Dict[int, List[list]] = {}  # {page: button rows}
+        self.page = 0
+        self.keyboard_edit: Optional[asyncio.Task] = None  # Pending debounced keyboard edit
+        self.monitor_tasks: Set[asyncio.Task] = set()  # Running monitor_jd_downloads tasks
+
+    def load_links(self, links: List[dict]):
+        """Store a LinkGrabber result, keeping known selections and selecting new links."""
+        # Precompute display strings once so keyboard renders only read them
+        for link in links:
+            name = link.get("name", "Unknown")
+            link['name'] = name
+            link['short_name'] = (name[:30] + '...') if len(name) > 33 else name
+            if 'size_str' not in link:
+                link['size_str'] = format_size(link.get("size", 0))
+            # Callback data and selection keys are strings; JD uuids are ints
+            link['uuid_key'] = str(link['uuid'])
+        self.cancel_keyboard_edit()
+        old_uuids = self.link_positions.keys()
+        self.links = links
+        self.link_positions = {l['uuid_key']: idx for idx, l in enumerate(links)}
+        new_uuids = self.link_positions.keys()
+        self.selected = (self.selected & new_uuids) | (new_uuids - old_uuids)
+        self.rendered_pages = {}
+        self.page = 0
+
+    @property
+    def total_pages(self) -> int:
+        """Number of keyboard pages needed for the cached links."""
+        return -(-len(self.links) // PAGE_SIZE)
+
+    def set_page(self, page: int) -> bool:
+        """Switch keyboard page, clamped to the pages that exist. Returns whether it moved."""
+        previous = self.page
+        self.page = max(0, min(page, self.total_pages - 1))
+        return self.page != previous
+
+    def toggle(self, uuid: str) -> Optional[bool]:
+        """
+        Flip a link's selection, patching only its cached button row.
+        Returns None for a uuid from an older keyboard that is no longer listed.
+        """
+        idx = self.link_positions.get(uuid)
+        if idx is None:
+            return None
+        is_selected = uuid not in self.selected
+        if is_selected:
+            self.selected.add(uuid)
+        else:
+            self.selected.discard(uuid)
+
+        page, row = divmod(idx, PAGE_SIZE)
+        rows = self.rendered_pages.get(page)
+        if rows is not None:
+            rows[row] = [_link_button(self.links[idx], is_selected)]
+        return is_selected
+
+    def set_all(self, is_selected: bool) -> bool:
+        """Select or deselect every cached link. Returns whether the selection changed."""
+        selected = set(self.link_positions) if is_selected else set()
+        if selected == self.selected:
+            return False
+        self.selected = selected
+        self.rendered_pages = {}
+        return True
+
+    def cancel_keyboard_edit(self):
+        """Drop a pending debounced toggle edit before the message is reused."""
+        if self.keyboard_edit and not self.keyboard_edit.done():
+            self.keyboard_edit.cancel()
+        self.keyboard_edit = None
+
+    def clear_links(self):
+        """Drop all cached selection state."""
+        self.cancel_keyboard_edit()
+        self.links = []
+        self.selected = set()
+        self.link_positions = {}
+        self.rendered_pages = {}
+        self.page = 0
+
+user_states: Dict[int, UserState] = {}
+
+def get_user_state(user_id: int) -> UserState:
+    """Get or create the state object for a user."""
+    ustate = user_states.get(user_id)
+    if ustate is None:
+        ustate = user_states[user_id] = UserState()
+    return ustate
+
+# Telegram file_ids of uploaded files, so a repeated link is re-sent instead of re-downloaded.
+_sent_media: "OrderedDict[tuple, List[tuple]]" = OrderedDict()  # {media key: [(file_id, caption)]}
+
+def media_cache_key(link: dict) -> Optional[tuple]:
+    """
+    Cache key for a LinkGrabber link. Plugins can emit several variants for
+    one URL (resolutions, audio-only), so the name and size are part of it.
+    """
+    url = link.get("url")
+    if not url or SENT_MEDIA_CACHE_SIZE <= 0:
+        return None
+    return url, link.get("name"), link.get("size")
+
+def get_cached_media(key: Optional[tuple]) -> Optional[List[tuple]]:
+    """Return the (file_id, caption) pairs already sent for a link, if still cached."""
+    if key is None:
+        return None
+    sent = _sent_media.get(key)
+    if sent is not None:
+        _sent_media.move_to_end(key)
+    return sent
+
+def _remember_media(key: tuple, sent: List[tuple]):
+    """Cache the (file_id, caption) pairs sent for a link, evicting the least recently used."""
+    _sent_media[key] = sent
+    _sent_media.move_to_end(key)
+    if len(_sent_media) > SENT_MEDIA_CACHE_SIZE:
+        _sent_media.popitem(last=False)
+
+async def send_cached_media(client, user_id: int, sent: List[tuple]):
+    """Re-send previously uploaded files by file_id, without touching JD or disk."""
+    for file_id, caption in sent:
+        await _send_with_flood_retry(
+            client.send_cached_media, chat_id=user_id, file_id=file_id, caption=caption
+        )
+
+# Bot-wide cap on message edits; Telegram throttles bots at ~30 msg/s overall.
+EDIT_RATE_LIMIT = 20  # edits per second
+_edit_queue: Optional[asyncio.Queue] = None
+_edit_worker_task: Optional[asyncio.Task] = None
+_edit_tasks: Set[asyncio.Task] = set()  # In-flight edits, referenced until they finish
+# Dedicated pool so long transcodes/splits never starve JD RPCs on the default executor
+_ffmpeg_executor = ThreadPoolExecutor(max_workers=FFMPEG_MAX_JOBS, thread_name_prefix="ffmpeg")
 
 # ============ UI Helpers ============
 
@@ -54,185 +261,280 @@ def format_jd_list_message(links: List[dict]) -> str:
     if not links:
         return "❌ No links found in LinkGrabber."
 
-    msg = "📋 **קבצים שנמצאו בסריקה:**\n━━━━━━━━━━━━━━━━━━\n"
+    msg = f"📋 **קבצים שנמצאו בסריקה:**\n{SEP}\n"
     for idx, link in enumerate(links):
-        size = format_size(link.get("bytes_total", 0))
-        name = link.get("name", "Unknown")
-        msg += f"{idx+1}. 📦 `{name}`\n   └ ⚖️ {size}\n"
-    msg += "━━━━━━━━━━━━━━━━━━\nבחר את הקבצים שברצונך להוריד המצאו מטה:"
+        msg += f"{idx+1}. 📦 `{link['name']}`\n   └ ⚖️ {link['size_str']}\n"
+    msg += f"{SEP}\nבחר את הקבצים שברצונך להוריד המצאו מטה:"
     return msg
 
-def get_jd_toggle_keyboard(user_id: int, links: List[dict], page: int = 0) -> InlineKeyboardMarkup:
+def _link_button(link: dict, is_selected: bool) -> InlineKeyboardButton:
+    """Build the selection button for a single LinkGrabber link."""
+    icon = "✅" if is_selected else "❌"
+    return InlineKeyboardButton(
+        f"{icon} {link['short_name']}",
+        callback_data=JD_TOGGLE_PREFIX + link['uuid_key']
+    )
+
+def get_jd_toggle_keyboard(ustate: UserState) -> InlineKeyboardMarkup:
     """Generate inline keyboard for JDownloader file selection with pagination."""
-    start_idx = page * 8
-    end_idx = start_idx + 8
-
-    toggle_states = jd_toggle_states.get(user_id, {})
-    buttons = []
-
-    # Selection buttons
-    for link in links[start_idx:end_idx]:
-        uuid = str(link.get("uuid"))
-        is_selected = toggle_states.get(uuid, True)
-        icon = "✅" if is_selected else "❌"
-        # Shorten name for button
-        name = link.get("name", "Unknown")
-        display_name = (name[:30] + '...') if len(name) > 33 else name
-        buttons.append([InlineKeyboardButton(
-            f"{icon} {display_name}",
-            callback_data=f"jd_toggle_{uuid}"
-        )])
+    links, page = ustate.links, ustate.page
+    # Selection buttons, rendered once per page and patched in place on toggle
+    rows = ustate.rendered_pages.get(page)
+    if rows is None:
+        start_idx = page * PAGE_SIZE
+        rows = [[_link_button(link, link['uuid_key'] in ustate.selected)]
+                for link in links[start_idx:start_idx + PAGE_SIZE]]
+        ustate.rendered_pages[page] = rows
+    buttons = list(rows)
 
     # Pagination row
     nav_row = []
-    total_pages = (len(links) + 7) // 8
+    total_pages = ustate.total_pages
     if total_pages > 1:
         if page > 0:
-            nav_row.append(InlineKeyboardButton("⬅️", callback_data=f"jd_page_{page-1}"))
+            nav_row.append(InlineKeyboardButton("⬅️", callback_data=JD_PAGE_PREFIX + str(page - 1)))
         nav_row.append(InlineKeyboardButton(f"📄 {page+1}/{total_pages}", callback_data="jd_noop"))
         if page < total_pages - 1:
-            nav_row.append(InlineKeyboardButton("➡️", callback_data=f"jd_page_{page+1}"))
+            nav_row.append(InlineKeyboardButton("➡️", callback_data=JD_PAGE_PREFIX + str(page + 1)))
     if nav_row:
         buttons.append(nav_row)
 
     # Bulk actions and controls
-    buttons.append([
-        InlineKeyboardButton("✨ בחר הכל", callback_data="jd_select_all"),
-        InlineKeyboardButton("🧹 בטל הכל", callback_data="jd_deselect_all")
-    ])
-    buttons.append([
-        InlineKeyboardButton("🔄 רענון", callback_data="jd_refresh"),
-        InlineKeyboardButton("➕ הוסף קישורים", callback_data="jd_add_more")
-    ])
-    buttons.append([
-        InlineKeyboardButton("🚀 התחל הורדה", callback_data="jd_confirm"),
-        InlineKeyboardButton("🗑️ ביטול", callback_data="jd_cancel")
-    ])
+    buttons.extend(SELECTION_CONTROL_ROWS)
 
     return InlineKeyboardMarkup(buttons)
 
 def render_dashboard(state: SessionState) -> str:
     """Render a comprehensive status dashboard for active downloads/uploads."""
-    text = "🚀 **מרכז בקרה - Siphon Bot**\n"
-    text += "━━━━━━━━━━━━━━━━━━\n\n"
+    parts = [DASHBOARD_HEADER]
 
     # 1. JDownloader Active Downloads
-    active = [d for d in state.jd_downloads if not d.get("finished")]
+    active = state.active_downloads
     if active:
-        text += "📥 **בהורדה מ-JD2:**\n"
+        parts.append(DOWNLOADS_TITLE)
         for dl in active[:3]: # Show top 3
-            name = dl.get("name", "Unknown")
             prog = dl.get("progress", 0)
-            p_bar = moon_progress_bar(prog)
-            speed = format_size(dl.get("speed", 0)) + "/s"
-            text += f"🔹 `{name[:35]}...`\n   {p_bar} {prog:.1f}%\n"
-            text += f"   └ ⚡ {speed}\n"
+            parts.append(DOWNLOAD_ITEM_TEMPLATE.format(
+                name=dl.get("name", "Unknown")[:35], bar=moon_progress_bar(prog),
+                progress=prog, speed=format_size(dl.get("speed", 0))
+            ))
         if len(active) > 3:
-            text += f"   _...ועוד {len(active)-3} קבצים בתור_\n"
-        text += "\n"
+            parts.append(QUEUED_TEMPLATE.format(count=len(active) - 3))
+        parts.append("\n")
     elif state.is_active:
-        text += "⌛ מעבד נתונים ב-JDownloader...\n\n"
-
-    # 2. Telegram Uploads
-    if state.active_uploads:
-        text += "📤 **בהעלאה לטלגרם:**\n"
-        for name, prog in state.active_uploads.items():
-            p_bar = moon_progress_bar(prog)
-            text += f"🔹 `{name[:35]}...`\n   {p_bar} {prog:.1f}%\n"
-        text += "\n"
+        parts.append(PROCESSING_LINE)
+
+    # 2. Telegram Uploads, oldest first: with FIFO upload slots those are the ones moving
+    uploads = state.active_uploads
+    if uploads:
+        parts.append(UPLOADS_TITLE)
+        for name, prog in islice(uploads.items(), 3):
+            parts.append(UPLOAD_ITEM_TEMPLATE.format(
+                name=name[:35], bar=moon_progress_bar(prog), progress=prog
+            ))
+        if len(uploads) > 3:
+            parts.append(QUEUED_TEMPLATE.format(count=len(uploads) - 3))
+        parts.append("\n")
 
     # 3. Completion Summary
-    if state.completed_tasks and not state.is_active and not state.active_uploads:
-        text += f"✅ **הסתיים!**\nקבצים שהושלמו: {len(state.completed_tasks)}\n"
-        return text
+    idle = not state.is_active and not state.active_uploads and not state.upload_tasks
+    if state.completed_tasks and idle:
+        parts.append(DONE_TEMPLATE.format(count=len(state.completed_tasks)))
+        return "".join(parts)
 
-    if not active and not state.active_uploads and not state.is_active:
-        return text + "🏁 כל המשימות הושלמו או שהתור ריק."
+    if not active and idle:
+        parts.append(EMPTY_LINE)
+        return "".join(parts)
 
     # ETA Calculation (Simple)
-    elapsed = time.time() - state.start_time
-    text += f"⏱️ זמן שחלף: `{int(elapsed//60)}m {int(elapsed%60)}s`\n"
-    return text
+    elapsed = int(time.time() - state.start_time)
+    parts.append(ELAPSED_TEMPLATE.format(minutes=elapsed // 60, seconds=elapsed % 60))
+    return "".join(parts)
+
+def _dashboard_signature(state: SessionState) -> int:
+    """
+    Hash of the dashboard fields at display granularity (0.5% progress,
+    0.25 MiB/s speed), so sub-visible jitter does not trigger an edit.
+    """
+    active = state.active_downloads
+    return hash((
+        tuple((d.get("name"), int(d.get("progress", 0) * 2), int(d.get("speed", 0) / 262144))
+              for d in active[:3]),
+        len(active),
+        tuple((name, int(prog * 2)) for name, prog in islice(state.active_uploads.items(), 3)),
+        len(state.active_uploads),
+        len(state.completed_tasks),
+        len(state.upload_tasks),
+        state.is_active
+    ))
 
 # ============ Background Tasks ============
 
-async def dashboard_loop(_client, _user_id, message, state: SessionState):
+async def _send_edit(client, chat_id, message_id, text, reply_markup, future):
+    try:
+        await client.edit_message_text(chat_id, message_id, text, reply_markup=reply_markup)
+    except Exception as err:  # pylint: disable=broad-except
+        if not future.done():
+            future.set_exception(err)
+    else:
+        # The waiter may have been cancelled meanwhile (e.g. a dashboard torn down)
+        if not future.done():
+            future.set_result(None)
+
+async def _edit_worker():
+    """
+    Start queued message edits at the bot-wide edit rate. Edits are not awaited
+    in turn, so a slow round trip doesn't lower the rate below EDIT_RATE_LIMIT.
+    """
+    while True:
+        item = await _edit_queue.get()
+        if item[-1].done():
+            continue  # Waiter cancelled before its turn; skip the edit
+        task = asyncio.create_task(_send_edit(*item))
+        _edit_tasks.add(task)
+        task.add_done_callback(_edit_tasks.discard)
+        await asyncio.sleep(1 / EDIT_RATE_LIMIT)
+
+async def queue_edit(client, chat_id: int, message_id: int, text: str, reply_markup=None):
+    """Edit a message through the shared rate-limited queue and wait for the result."""
+    global _edit_queue, _edit_worker_task  # pylint: disable=global-statement
+    if _edit_queue is None:
+        _edit_queue = asyncio.Queue()
+        _edit_worker_task = asyncio.create_task(_edit_worker())
+    future = asyncio.get_running_loop().create_future()
+    await _edit_queue.put((client, chat_id, message_id, text, reply_markup, future))
+    await future
+
+async def dashboard_loop(client, chat_id: int, message_id: int, state: SessionState):
     """Periodically update the dashboard message."""
-    last_text = ""
+    last_signature = None
     error_count = 0
-    # pylint: disable=simplifiable-condition
-    active_cond = (
-        state.is_active or state.active_uploads or
-        (state.jd_downloads and not all(d.get("finished") for d in state.jd_downloads))
-    )
-    # pylint: enable=simplifiable-condition
-    while active_cond:
+    while (state.is_active or state.active_uploads or state.active_downloads
+           or state.upload_tasks):
         try:
-            current_text = render_dashboard(state)
-            if current_text != last_text:
-                await message.edit_text(
-                    current_text,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🛑 ביטול הורדה", callback_data="jd_cancel_active")]
-                    ])
+            signature = _dashboard_signature(state)
+            if signature != last_signature:
+                await queue_edit(
+                    client, chat_id, message_id,
+                    render_dashboard(state),
+                    reply_markup=DASHBOARD_MARKUP
                 )
-                last_text = current_text
+                last_signature = signature
                 error_count = 0
-            await asyncio.sleep(2.5)
+            await asyncio.sleep(DASHBOARD_MIN_INTERVAL)
+            try:
+                await asyncio.wait_for(state.changed.wait(), timeout=DASHBOARD_IDLE_REFRESH)
+            except asyncio.TimeoutError:
+                pass
+            state.changed.clear()
+        except FloodWait as err:
+            logger.warning("Dashboard edit throttled, waiting %ss", err.value)
+            await asyncio.sleep(err.value + 0.5)
         except Exception as err:  # pylint: disable=broad-except
             logger.error("Error in dashboard_loop: %s", err)
             error_count += 1
             if error_count > 5:
                 logger.error("Too many errors in dashboard_loop, stopping.")
                 break
-            await asyncio.sleep(5)
-        # pylint: disable=simplifiable-condition
-        active_cond = (
-            state.is_active or state.active_uploads or
-            (state.jd_downloads and not all(d.get("finished") for d in state.jd_downloads))
-        )
-        # pylint: enable=simplifiable-condition
+            await asyncio.sleep(min(60, 2.5 * 2 ** error_count))
     # Final update
     try:
-        await message.delete()
+        await client.delete_messages(chat_id, message_id)
     except Exception as err:  # pylint: disable=broad-except
         logger.error("Error on final dashboard update: %s", err)
 
-async def send_album_to_telegram(_client, user_id: int, image_batch: list, state: SessionState):
-    """Send a batch of images as an album."""
-    if not image_batch:
-        return
+async def run_ffmpeg_job(func, *args, **kwargs):
+    """Run a blocking ffmpeg helper on the ffmpeg pool, at most FFMPEG_MAX_JOBS at once."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _ffmpeg_executor, functools.partial(func, *args, **kwargs))
 
-    jd = None
+def _remove_files(paths):
+    """Delete local files, ignoring ones that are already gone."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logger.error("Failed to remove file %s: %s", path, err)
+
+async def remove_files(*paths):
+    """Delete local files off the event loop in a single worker-thread hop."""
+    paths = [p for p in paths if p]
+    if paths:
+        await asyncio.to_thread(_remove_files, paths)
+
+async def _flush_jd_removals(state: SessionState):
+    """Remove all queued JD links in a single RPC."""
+    if not state.pending_jd_removals:
+        return
+    batch = list(state.pending_jd_removals)
+    state.pending_jd_removals.clear()
     try:
-        jd = get_jd_client()
-    except Exception as err: # pylint: disable=broad-except
-        logger.error("Failed to get JD client for album cleanup: %s", err)
-
-    # Telegram allows max 10 files per album
-    for i in range(0, len(image_batch), 10):
-        chunk = image_batch[i:i+10]
-        media_group = [InputMediaPhoto(media=item['path'], caption=item['name'] if j==0 else "")
-                       for j, item in enumerate(chunk)]
+        await get_async_jd_client().remove_links(batch)
+    except Exception as err:  # pylint: disable=broad-except
+        logger.warning("Failed to remove JD links %s: %s", batch, err)
 
-        paths_to_clean = [item['path'] for item in chunk]
-        uuids_to_remove = [item['uuid'] for item in chunk if item.get('uuid')]
+async def _queue_jd_removal(state: SessionState, uuids):
+    """Queue JD links for the monitor's next flush, or flush now if it has exited."""
+    state.pending_jd_removals.update(uuids)
+    if not state.is_active:
+        await _flush_jd_removals(state)
 
+async def _send_with_flood_retry(send, **kwargs):
+    """Call a Pyrogram send method, sleeping out FloodWait between attempts."""
+    for attempt in range(FLOOD_WAIT_RETRIES):
         try:
-            await _client.send_media_group(chat_id=user_id, media=media_group)
-            for path in paths_to_clean:
-                if os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except Exception as err:  # pylint: disable=broad-except
-                        logger.error("Failed to remove file %s: %s", path, err)
-            if jd and uuids_to_remove:
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(executor, jd.remove_links, uuids_to_remove)
-            for item in chunk:
-                state.completed_tasks.append(item['name'])
-        except Exception as err:  # pylint: disable=broad-except
-            logger.error("Failed to send album: %s", err)
+            return await send(**kwargs)
+        except FloodWait as err:
+            if attempt == FLOOD_WAIT_RETRIES - 1:
+                raise
+            logger.warning("Send throttled, retrying in %ss", err.value)
+            await asyncio.sleep(err.value + 0.5)
+    return None
+
+async def send_album_to_telegram(_client, user_id: int, album: list, state: SessionState):
+    """Send up to ALBUM_SIZE images as one album."""
+    if not album:
+        return
+
+    # A vanished image would make Telegram reject the whole group, so drop it here
+    present = await asyncio.to_thread(
+        lambda: [item for item in album if os.path.exists(item['path'])]
+    )
+    for item in album:
+        if item not in present:
+            logger.warning("Downloaded image missing on disk: %s", item['path'])
+            try:
+                await _client.send_message(
+                    user_id, f"❌ **שגיאה בהעלאת הקובץ:** `{item['name']}`\nFile not found"
+                )
+            except Exception:  # pylint: disable=broad-except
+                pass
+    album = present
+    if not album:
+        return
+
+    media_group = [InputMediaPhoto(media=item['path'], caption=item['name'] if j==0 else "")
+                   for j, item in enumerate(album)]
+
+    paths_to_clean = [item['path'] for item in album]
+    uuids_to_remove = [item['uuid'] for item in album if item.get('uuid')]
+
+    try:
+        async with state.upload_sem:
+            await _send_with_flood_retry(
+                _client.send_media_group, chat_id=user_id, media=media_group
+            )
+        await remove_files(*paths_to_clean)
+        if uuids_to_remove:
+            await _queue_jd_removal(state, uuids_to_remove)
+        for item in album:
+            state.completed_tasks.append(item['name'])
+        state.changed.set()
+    except Exception as err:  # pylint: disable=broad-except
+        logger.error("Failed to send album: %s", err)
 
 async def upload_jd_file_to_telegram(
         _client, user_id: int, file_path: str, state: SessionState, uuid: str = None
@@ -242,13 +544,13 @@ async def upload_jd_file_to_telegram(
     state.active_uploads[filename] = 0
 
     try:
-        # Check if needs conversion
+        # Only videos are probed/converted/split; documents go up as-is
         target_path = file_path
-        loop = asyncio.get_event_loop()
-        needs_conv = await loop.run_in_executor(executor, needs_conversion, file_path)
+        is_video = os.path.splitext(file_path)[1].lower() in VIDEO_EXTENSIONS
+        needs_conv = is_video and await asyncio.to_thread(needs_conversion, file_path)
         if needs_conv:
             state.active_uploads[filename] = 0.5 # Dummy progress for conversion
-            target_path = await loop.run_in_executor(executor, convert_to_mp4, file_path)
+            target_path = await run_ffmpeg_job(convert_to_mp4, file_path)
             if target_path != file_path:
                 state.active_uploads.pop(filename, None)
                 filename = os.path.basename(target_path)
@@ -256,10 +558,13 @@ async def upload_jd_file_to_telegram(
 
         # Check size (2GB limit)
         files_to_upload = [target_path]
-        file_size = await loop.run_in_executor(executor, os.path.getsize, target_path)
+        parent_meta = None
+        sent_media = []  # (file_id, caption) per part, for the re-send cache
+        file_size = await asyncio.to_thread(os.path.getsize, target_path) if is_video else 0
         if file_size > 1.9 * 1024**3:
-            # pylint: disable=too-many-function-args
-            files_to_upload = await loop.run_in_executor(executor, split_video, target_path)
+            # Probe once; the parts reuse the parent's dimensions and thumbnail
+            parent_meta = await run_ffmpeg_job(get_video_metadata, target_path)
+            files_to_upload = await run_ffmpeg_job(split_video, target_path, meta=parent_meta)
 
         try:
             for part_path in files_to_upload:
@@ -274,33 +579,41 @@ async def upload_jd_file_to_telegram(
                 # pylint: disable=cell-var-from-loop
                 async def progress(current, total, name=t_name):
                     state.active_uploads[name] = (current / total) * 100
+                    state.changed.set()
 
                 try:
-                    await _send_upload_chunk(_client, user_id, part_path, p_name, progress)
+                    # Only the transfer takes an upload slot; conversion/split
+                    # above is already bounded by the ffmpeg pool
+                    async with state.upload_sem:
+                        sent = await _send_upload_chunk(
+                            _client, user_id, part_path, p_name, progress, parent_meta
+                        )
+                    media = sent and (sent.video or sent.document)
+                    if media:
+                        sent_media.append((media.file_id, f"✅ {p_name}"))
                 finally:
                     state.active_uploads.pop(t_name, None)
 
-                if part_path != target_path and os.path.exists(part_path):
-                    os.remove(part_path)
+                if part_path != target_path:
+                    await remove_files(part_path)
         except Exception as chunk_err:
             logger.error("Error during chunk upload loop: %s", chunk_err)
             raise chunk_err
+        finally:
+            if parent_meta:
+                await remove_files(parent_meta[3])
 
         # Cleanup and task completion
         if uuid:
-            try:
-                await asyncio.get_event_loop().run_in_executor(
-                    executor, get_jd_client().remove_links, [uuid]
-                )
-            except Exception as err:  # pylint: disable=broad-except
-                logger.warning("Failed to remove JD link %s: %s", uuid, err)
+            await _queue_jd_removal(state, [uuid])
+            media_key = state.media_keys.get(str(uuid))
+            if media_key and len(sent_media) == len(files_to_upload):
+                _remember_media(media_key, sent_media)
 
         state.completed_tasks.append(filename)
+        state.changed.set()
 
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        if target_path != file_path and os.path.exists(target_path):
-            os.remove(target_path)
+        await remove_files(file_path, target_path if target_path != file_path else None)
 
     except Exception as err:  # pylint: disable=broad-except
         logger.error("Upload error for %s: %s", file_path, err)
@@ -308,176 +621,240 @@ async def upload_jd_file_to_telegram(
             await _client.send_message(user_id, f"❌ **שגיאה בהעלאת הקובץ:** `{filename}`\n{str(err)[:100]}")
         except Exception:
             pass
-async def _send_upload_chunk(client, user_id, part_path, part_name, progress):
-    """Helper to send a single video or document chunk."""
+async def _send_upload_chunk(client, user_id, part_path, part_name, progress, parent_meta=None):
+    """Helper to send a single video or document chunk; returns the sent message."""
     try:
-        if part_path.lower().endswith(tuple(VIDEO_EXTENSIONS)):
-            # get_video_metadata is now sync and runs ffmpeg, so run in executor
-            meta = await asyncio.get_event_loop().run_in_executor(
-                executor, get_video_metadata, part_path
-            )
-            width, height, duration, thumb = meta
-            await client.send_video(
+        if os.path.splitext(part_path)[1].lower() in VIDEO_EXTENSIONS:
+            # Metadata helpers are sync and run ffmpeg, so run them in a worker thread
+            if parent_meta:
+                # Split part: only its duration differs from the parent file
+                width, height, _, thumb = parent_meta
+                duration = await asyncio.to_thread(get_video_duration, part_path)
+            else:
+                width, height, duration, thumb = await run_ffmpeg_job(
+                    get_video_metadata, part_path
+                )
+            sent = await _send_with_flood_retry(
+                client.send_video,
                 chat_id=user_id, video=part_path, caption=f"✅ {part_name}",
                 duration=duration, width=width, height=height, thumb=thumb,
                 progress=progress
             )
-            if thumb and os.path.exists(thumb):
-                os.remove(thumb)
+            if not parent_meta:
+                await remove_files(thumb)
         else:
-            await client.send_document(
+            sent = await _send_with_flood_retry(
+                client.send_document,
                 chat_id=user_id, document=part_path, caption=f"✅ {part_name}",
                 progress=progress
             )
+        return sent
     except Exception as err: # pylint: disable=broad-except
         logger.error("Upload failed for %s: %s", part_name, err)
         raise err
 
-async def monitor_jd_downloads(_client, user_id: int, status_msg, expected_uuids: list):
-    """Monitor JD downloads and trigger uploads."""
+async def monitor_jd_downloads(_client, user_id: int, chat_id: int, message_id: int,
+                               expected_uuids: tuple, media_keys: Dict[str, tuple] = None):
+    """Monitor JD downloads and trigger uploads; the dashboard edits chat_id/message_id."""
     state = SessionState()
-    user_sessions[user_id] = state
+    state.media_keys = media_keys or {}
+    get_user_state(user_id).session = state
     state.is_active = True
 
     try:
-        get_jd_client().start_downloads()
+        await get_async_jd_client().start_downloads()
     except Exception as err:  # pylint: disable=broad-except
         logger.error("Failed to start downloads: %s", err)
         state.is_active = False
+        _release_session(user_id, state)
         return
 
-    asyncio.create_task(dashboard_loop(_client, user_id, status_msg, state))
+    state.dashboard_task = asyncio.create_task(dashboard_loop(
+        _client, chat_id, message_id, state))
 
+    # Same raw JD uuid values as the download status entries, so no per-poll str()
+    expected = frozenset(expected_uuids)
     uploaded_files = set()
-    image_buffer = []
-    last_batch_time = time.time()
+    images = asyncio.Queue()
+    # Tracked like an upload so the dashboard stays up until the last album is queued
+    _spawn_upload(state, _album_consumer(_client, user_id, state, images))
 
+    interval = POLL_INTERVAL_ACTIVE
     while True:
-        await asyncio.sleep(3)
-        relevant = await _get_relevant_downloads(expected_uuids, state)
+        await asyncio.sleep(interval)
+        relevant = await _get_relevant_downloads(expected, state)
         if not relevant:
+            interval = POLL_INTERVAL_IDLE
             continue
 
         for dl in relevant:
-            if dl.get("finished") and dl.get("uuid") not in uploaded_files:
-                uploaded_files.add(dl.get("uuid"))
-                _handle_downloaded_file(_client, user_id, dl, state, image_buffer)
+            uuid = dl["uuid"]
+            if dl.get("finished") and uuid not in uploaded_files:
+                uploaded_files.add(uuid)
+                _handle_downloaded_file(_client, user_id, dl, state, images)
 
-        _check_batch_uploads(_client, user_id, state, image_buffer, last_batch_time)
+        await _flush_jd_removals(state)
 
-        if all(d.get("finished") for d in relevant) and \
-           len(uploaded_files) >= len(relevant) and not image_buffer:
+        if all(d.get("finished") for d in relevant) and len(uploaded_files) >= len(relevant):
+            images.put_nowait(_END_OF_IMAGES)
             state.is_active = False
+            state.changed.set()
             break
 
-async def _get_relevant_downloads(uuids, state):
-    """Fetch status and update state, return relevant items."""
-    downloads = await asyncio.get_event_loop().run_in_executor(
-        executor, get_jd_client().get_download_status
-    )
-    str_uuids = [str(u) for u in uuids]
-    relevant = [d for d in downloads if str(d.get("uuid")) in str_uuids]
+        interval = POLL_INTERVAL_ACTIVE if state.transferring else POLL_INTERVAL_IDLE
+
+    # Uploads still running queue their removals directly from here on
+    await _flush_jd_removals(state)
+
+    # The dashboard outlives the poll loop until the last upload finishes
+    await asyncio.gather(state.dashboard_task, return_exceptions=True)
+    _release_session(user_id, state)
+
+def _release_session(user_id: int, state: SessionState):
+    """Drop a finished session so its download/upload history can be freed."""
+    ustate = user_states.get(user_id)
+    if ustate is not None and ustate.session is state:
+        ustate.session = None
+
+async def _get_relevant_downloads(uuids: frozenset, state):
+    """Fetch status and update state, return items whose uuid is in uuids."""
+    downloads = await get_async_jd_client().get_download_status()
+    relevant, active, transferring = [], [], False
+    # One pass: filter to this session, split out unfinished, note any live transfer
+    for d in downloads:
+        if d["uuid"] in uuids:
+            relevant.append(d)
+            if not d.get("finished"):
+                active.append(d)
+                transferring = transferring or bool(d.get("speed"))
     state.jd_downloads = relevant
+    state.active_downloads = active
+    state.transferring = transferring
+    # Only wake the dashboard when the poll actually moved something
+    snapshot = tuple((d["uuid"], d.get("finished"), d.get("bytes_loaded"), d.get("speed"))
+                     for d in relevant)
+    if snapshot != state.poll_snapshot:
+        state.poll_snapshot = snapshot
+        state.changed.set()
     return relevant
 
 async def process_jd_links(_client, user_id, message_to_edit, urls, deep_scan=False):
     """Fetch links and show selection UI."""
+    ustate = get_user_state(user_id)
     try:
-        active_scans[user_id] = True
+        ustate.scanning = True
+        jd = get_async_jd_client()
         for url in urls:
-            await asyncio.get_event_loop().run_in_executor(
-                executor, get_jd_client().add_to_linkgrabber, url, None, deep_scan
-            )
+            await jd.add_to_linkgrabber(url, None, deep_scan)
 
         # Periodic check for links
-        links = await _wait_for_links(user_id, message_to_edit, deep_scan)
-
-        links = await asyncio.get_event_loop().run_in_executor(
-            executor, get_jd_client().get_linkgrabber_links, False
-        )
+        links, stable = await _wait_for_links(ustate, message_to_edit, deep_scan)
+        if not stable:
+            # Timeout or stop button: the last poll is a sleep old, catch what JD added since
+            links = await jd.get_linkgrabber_links(False)
         unique_links = _deduplicate_links(links)
 
-        jd_linkgrabber_cache[user_id] = unique_links
-        jd_toggle_states[user_id] = {str(l['uuid']): True for l in unique_links}
+        ustate.load_links(unique_links)
 
         await message_to_edit.edit_text(
             format_jd_list_message(unique_links),
-            reply_markup=get_jd_toggle_keyboard(user_id, unique_links, 0)
+            reply_markup=get_jd_toggle_keyboard(ustate)
         )
     except Exception as err: # pylint: disable=broad-except
         logger.error("JD Process error: %s", err)
         await message_to_edit.edit_text(f"❌ Error: {str(err)[:50]}")
     finally:
-        active_scans.pop(user_id, None)
+        ustate.scanning = False
 
 def _deduplicate_links(links):
-    """Remove duplicates and limit count."""
-    unique = []
-    seen = set()
-    for l_item in links:
-        if l_item['uuid'] not in seen:
-            unique.append(l_item)
-            seen.add(l_item['uuid'])
-    return unique[:250]
-def _is_scan_stable(links, last_count, stable_duration, deep_scan):
-    if not links or len(links) <= 5 or deep_scan:
-        return False
-    if len(links) == last_count:
-        stable_duration += 2
-    else:
-        stable_duration = 0
-    return stable_duration >= 6
+    """Remove duplicates (insertion-ordered, by uuid) and limit count."""
+    return list({l_item['uuid']: l_item for l_item in links}.values())[:250]
+def _is_scan_stable(count, stable_duration, deep_scan):
+    return not deep_scan and count > 5 and stable_duration >= 6
 
 async def _update_scan_msg(msg, count):
     try:
         await msg.edit_text(
             f"⏳ **מעבד... נמצאו {count} קישורים**\nלחץ על עצור לסיום.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🛑 עצור וסנן", callback_data="scan_stop")
-            ]])
+            reply_markup=SCAN_MARKUP
         )
     except Exception:  # pylint: disable=broad-except
         pass
-def _handle_downloaded_file(client, user_id, dl, state, buffer):
+def _spawn_upload(state: SessionState, coro):
+    """Queue an upload as a task owned by the session so it can't be collected mid-run."""
+    task = asyncio.create_task(coro)
+    state.upload_tasks.add(task)
+    task.add_done_callback(state.upload_tasks.discard)
+    task.add_done_callback(lambda _: state.changed.set())
+
+def _handle_downloaded_file(client, user_id, dl, state, images: asyncio.Queue):
     """Process a finished download."""
-    uuid = dl.get("uuid")
-    pkg_name = dl.get("package_name", "Unknown")
-    file_name = dl.get("name", "Unknown")
-    dir_path = os.getenv("JD_DOWNLOAD_DIR", "downloads")
-    path = os.path.join(dir_path, pkg_name, file_name)
-    if not os.path.exists(path):
-        path = os.path.join(dir_path, file_name)
-
-    if os.path.exists(path):
-        ext = os.path.splitext(path)[1].lower()
-        if ext in {'.jpg', '.jpeg', '.png', '.webp'}:
-            buffer.append({'path': path, 'uuid': uuid, 'name': file_name})
-        else:
-            asyncio.create_task(upload_jd_file_to_telegram(client, user_id, path, state, uuid))
+    # local_path was resolved on the JD worker thread; a missing file surfaces
+    # as FileNotFoundError in the upload path instead of a stat here.
+    path = dl.get("local_path")
+    if not path:
+        logger.warning("No local path for finished download: %s", dl.get("name"))
+        return
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        images.put_nowait({'path': path, 'uuid': dl["uuid"], 'name': dl.get("name", "Unknown")})
     else:
-        logger.warning("File not found: %s", path)
-
-def _check_batch_uploads(client, user_id, state, buffer, last_time):
-    if buffer and (len(buffer) >= 10 or time.time() - last_time > 10):
-        batch = buffer[:]
-        buffer.clear()
-        asyncio.create_task(send_album_to_telegram(client, user_id, batch, state))
-async def _wait_for_links(user_id, msg, deep_scan):
-    """Wait for LinkGrabber to stabilize and return links."""
+        _spawn_upload(state, upload_jd_file_to_telegram(client, user_id, path, state, dl["uuid"]))
+
+_END_OF_IMAGES = object()  # Queued by the monitor once no more images can arrive
+
+async def _album_consumer(client, user_id, state, images: asyncio.Queue):
+    """
+    Group queued images into albums of ALBUM_SIZE, flushing early once images
+    stop arriving. Albums go out one at a time, ALBUM_CHUNK_DELAY apart.
+    """
+    batch = []
+    done = False
+    next_send = 0.0
+    while not done:
+        try:
+            item = await asyncio.wait_for(images.get(), timeout=ALBUM_IDLE_FLUSH)
+        except asyncio.TimeoutError:
+            item = None
+        if item is _END_OF_IMAGES:
+            done = True
+        elif item is not None:
+            batch.append(item)
+            if len(batch) < ALBUM_SIZE:
+                continue
+        if batch:
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await send_album_to_telegram(client, user_id, batch, state)
+            next_send = time.monotonic() + ALBUM_CHUNK_DELAY
+            batch = []
+async def _wait_for_links(ustate, msg, deep_scan):
+    """Wait for LinkGrabber to stabilize; return (links, whether the count settled)."""
     total_wait = 30 if deep_scan else 10
-    elapsed, last_count, stable_duration = 0, 0, 0
+    elapsed, last_count, stable_duration, shown_count = 0, 0, 0, 0
+    step, delay = 0, SCAN_POLL_DELAYS[0]
     links = []
     while elapsed < total_wait:
-        if not active_scans.get(user_id):
-            break
-        links = await asyncio.get_event_loop().run_in_executor(
-            executor, get_jd_client().get_linkgrabber_links, False
-        )
-        if _is_scan_stable(links, last_count, stable_duration, deep_scan):
+        if not ustate.scanning:
             break
-        elapsed += 2
-        await asyncio.sleep(2)
-        if elapsed % 4 == 0:
-            await _update_scan_msg(msg, len(links))
-        last_count = len(links)
-    return links
+        links = await get_async_jd_client().get_linkgrabber_links(False)
+        count = len(links)
+        if count == last_count:
+            stable_duration += delay
+            step += 1
+        else:
+            stable_duration, step = 0, 0
+        if _is_scan_stable(count, stable_duration, deep_scan):
+            return links, True
+        # Never sleep past the deadline; process_jd_links polls once more at the end
+        delay = min(SCAN_POLL_DELAYS[min(step, len(SCAN_POLL_DELAYS) - 1)], total_wait - elapsed)
+        elapsed += delay
+        await asyncio.sleep(delay)
+        # Only edit when the count actually moved
+        if count != shown_count:
+            await _update_scan_msg(msg, count)
+            shown_count = count
+        last_count = count
+    return links, False
@@ -4,8 +4,11 @@ Uses myjdapi to communicate with JDownloader 2 via My.JDownloader API.
 """
 
 import os
+import asyncio
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Union
 from dotenv import load_dotenv
 from utils import format_size
@@ -18,6 +21,10 @@ except ImportError:
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+JD_RPC_WORKERS = 4  # Threads dedicated to blocking My.JDownloader calls
+JD_KEEPALIVE_INTERVAL = 240  # Seconds between keepalive checks
+JD_SESSION_IDLE = 300  # Idle seconds after which the session is pinged before it expires
+
 
 class JDownloaderClient:
     """Wrapper for My.JDownloader API interactions."""
@@ -37,15 +44,23 @@ class JDownloaderClient:
         self.jd = myjdapi.Myjdapi()
         self.device = None
         self._connected = False
+        self._last_ok = 0.0  # monotonic time of the last successful call
+        # RPCs run on several worker threads; only one may (re)build the session at a time
+        self._connect_lock = threading.RLock()
 
     def connect(self) -> bool:
         """Connect to My JDownloader."""
+        with self._connect_lock:
+            return self._connect()
+
+    def _connect(self) -> bool:
         try:
             logger.info("🔌 Connecting to My.JDownloader...")
             self.jd.connect(self.email, self.password)
             self.device = self.jd.get_device(self.device_name)
             if self.device:
                 self._connected = True
+                self._last_ok = time.monotonic()
                 logger.info("✅ Connected to JDownloader: %s", self.device_name)
                 return True
             logger.error("❌ Device '%s' not found.", self.device_name)
@@ -57,17 +72,21 @@ class JDownloaderClient:
     def ensure_connected(self) -> bool:
         """Ensure we have an active connection."""
         if not self._connected or self.device is None:
-            return self.connect()
+            with self._connect_lock:
+                # Another worker may have connected while this one waited
+                if not self._connected or self.device is None:
+                    return self._connect()
         return True
 
     def reconnect(self) -> bool:
         """Force reconnection to My.JDownloader."""
         try:
-            logger.info("🔄 Token invalid or session expired. Reconnecting...")
-            self.device = None
-            self._connected = False
-            # Optional: self.jd.disconnect() if supported, but usually just re-calling connect works
-            return self.connect()
+            with self._connect_lock:
+                logger.info("🔄 Token invalid or session expired. Reconnecting...")
+                self.device = None
+                self._connected = False
+                # Optional: self.jd.disconnect() if supported, but usually just re-calling connect works
+                return self._connect()
         except Exception as err: # pylint: disable=broad-except
             logger.error("❌ Reconnection failed: %s", err)
             return False
@@ -79,7 +98,9 @@ class JDownloaderClient:
             try:
                 if not self.ensure_connected():
                     return default_return
-                return action()
+                result = action()
+                self._last_ok = time.monotonic()
+                return result
             except Exception as err:
                 err_name = type(err).__name__
                 if err_name in ("TokenExpiredException", "TokenException"):
@@ -94,6 +115,14 @@ class JDownloaderClient:
                 time.sleep(1)
         return default_return
 
+    def keep_alive(self) -> bool:
+        """Ping JD after a long idle spell so an expired session is renewed off the user's path."""
+        if not self._connected or time.monotonic() - self._last_ok < JD_SESSION_IDLE:
+            return self._connected
+        logger.debug("JD session idle, sending keepalive")
+        self.is_collecting()
+        return self._connected
+
     def add_to_linkgrabber(self, url: str, package_name: str = None,
                            deep_scan: Union[bool, int] = False) -> bool:
         """Add links to LinkGrabber."""
@@ -140,10 +169,10 @@ class JDownloaderClient:
                 packages = self.device.linkgrabber.query_packages() # pylint: disable=no-member
 
                 all_links = []
-                for pkg in packages:
-                    pkg_uuid = pkg.get("uuid")
+                if packages:
+                    # One query for every package's links instead of one per package
                     l_params = [{
-                        "packageUUIDs": [pkg_uuid],
+                        "packageUUIDs": [pkg.get("uuid") for pkg in packages],
                         "bytesTotal": True,
                         "url": True,
                         "status": True
@@ -160,7 +189,7 @@ class JDownloaderClient:
                             "size": link.get("size", 0),
                             "size_str": format_size(link.get("size", 0)),
                             "enabled": link.get("enabled", True),
-                            "package_uuid": pkg.get("uuid"),
+                            "package_uuid": link.get("packageUUID"),
                             "availability": link.get("availability", "UNKNOWN")
                         })
 
@@ -275,51 +304,55 @@ class JDownloaderClient:
         def action():
             packages = self.device.downloads.query_packages() # pylint: disable=no-member
             all_downloads = []
+            if not packages:
+                return all_downloads
+
+            # Use package save location if available
+            save_locations = {pkg.get("uuid"): pkg.get("saveLocation", self.download_dir)
+                              for pkg in packages}
+            # One query for every package's links instead of one per package
+            links = self.device.downloads.query_links(
+                params=[{  # pylint: disable=no-member
+                    "packageUUIDs": list(save_locations),
+                    "bytesLoaded": True,
+                    "bytesTotal": True,
+                    "speed": True,
+                    "eta": True,
+                    "finished": True,
+                    "status": True,
+                    "running": True
+                }]
+            )
 
-            for pkg in packages:
-                pkg_links = self.device.downloads.query_links(
-                    params=[{  # pylint: disable=no-member
-                        "packageUUIDs": [pkg.get("uuid")],
-                        "bytesLoaded": True,
-                        "bytesTotal": True,
-                        "speed": True,
-                        "eta": True,
-                        "finished": True,
-                        "status": True,
-                        "running": True
-                    }]
-                )
-                # Use package save location if available
-                save_location = pkg.get("saveLocation", self.download_dir)
-
-                for link in pkg_links:
-                    bytes_total = link.get("bytesTotal", 0)
-                    bytes_loaded = link.get("bytesLoaded", 0)
-                    progress = (bytes_loaded / bytes_total * 100) if bytes_total > 0 else 0
-
-                    # Calculate correct local path for this specific link
-                    save_location = pkg.get("saveLocation", self.download_dir)
-                    local_path = os.path.join(save_location, link.get("name", ""))
-
-                    # Fallback to default download dir if not found in package dir
-                    if not os.path.exists(local_path):
-                        flat_path = os.path.join(self.download_dir, link.get("name", ""))
-                        if os.path.exists(flat_path):
-                            local_path = flat_path
-
-                    all_downloads.append({
-                        "uuid": link.get("uuid"),
-                        "name": link.get("name", "Unknown"),
-                        "progress": progress,
-                        "bytes_total": bytes_total,
-                        "bytes_loaded": bytes_loaded,
-                        "speed": link.get("speed", 0),
-                        "eta": link.get("eta", 0),
-                        "status": link.get("status", "UNKNOWN"),
-                        "finished": link.get("finished", False),
-                        "running": link.get("running", False),
-                        "local_path": local_path
-                    })
+            for link in links:
+                save_location = save_locations.get(link.get("packageUUID"), self.download_dir)
+                bytes_total = link.get("bytesTotal", 0)
+                bytes_loaded = link.get("bytesLoaded", 0)
+                progress = (bytes_loaded / bytes_total * 100) if bytes_total > 0 else 0
+
+                # Calculate correct local path for this specific link
+                local_path = os.path.join(save_location, link.get("name", ""))
+
+                # Fallback to default download dir if not found in package dir;
+                # only finished files exist on disk, so skip the stat otherwise
+                if link.get("finished", False) and not os.path.exists(local_path):
+                    flat_path = os.path.join(self.download_dir, link.get("name", ""))
+                    if os.path.exists(flat_path):
+                        local_path = flat_path
+
+                all_downloads.append({
+                    "uuid": link.get("uuid"),
+                    "name": link.get("name", "Unknown"),
+                    "progress": progress,
+                    "bytes_total": bytes_total,
+                    "bytes_loaded": bytes_loaded,
+                    "speed": link.get("speed", 0),
+                    "eta": link.get("eta", 0),
+                    "status": link.get("status", "UNKNOWN"),
+                    "finished": link.get("finished", False),
+                    "running": link.get("running", False),
+                    "local_path": local_path
+                })
 
             return all_downloads
 
@@ -354,9 +387,81 @@ class JDownloaderClient:
         return self._execute_with_retry(action, default_return=False)
 
 
+class AsyncJDClient:
+    """
+    Awaitable facade over JDownloaderClient.
+    myjdapi only speaks the encrypted My.JDownloader protocol through blocking
+    HTTP calls, so every call runs in a worker thread and the bot coroutines
+    simply await the result. The calls get their own small pool: retries and
+    LinkGrabber waits sleep inside the thread and must not hold up file work
+    on the default executor.
+    """
+
+    def __init__(self, client: JDownloaderClient):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=JD_RPC_WORKERS,
+                                           thread_name_prefix="jd-rpc")
+        self._keepalive_task: Optional[asyncio.Task] = None
+
+    async def _call(self, func, *args):
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _keepalive(self):
+        """Keep the My.JDownloader session warm between user requests."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(JD_KEEPALIVE_INTERVAL)
+            try:
+                await loop.run_in_executor(self.executor, self.client.keep_alive)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning("JD keepalive failed: %s", err)
+
+    async def add_to_linkgrabber(self, url: str, package_name: str = None,
+                                 deep_scan: Union[bool, int] = False) -> bool:
+        """Add links to LinkGrabber."""
+        return await self._call(self.client.add_to_linkgrabber, url, package_name, deep_scan)
+
+    async def get_linkgrabber_links(self, wait_for_extraction: bool = True,
+                                    timeout: int = 30) -> List[Dict]:
+        """Get list of links from LinkGrabber."""
+        return await self._call(self.client.get_linkgrabber_links,
+                                wait_for_extraction, timeout)
+
+    async def move_to_downloads(self, link_uuids: List[int] = None,
+                                package_uuids: List[int] = None) -> bool:
+        """Move links from LinkGrabber to Downloads."""
+        return await self._call(self.client.move_to_downloads, link_uuids, package_uuids)
+
+    async def abort_crawling(self) -> bool:
+        """Abort current LinkGrabber crawling process."""
+        return await self._call(self.client.abort_crawling)
+
+    async def is_collecting(self) -> bool:
+        """Check if LinkGrabber is currently collecting/crawling."""
+        return await self._call(self.client.is_collecting)
+
+    async def clear_linkgrabber(self) -> bool:
+        """Clear all links from LinkGrabber."""
+        return await self._call(self.client.clear_linkgrabber)
+
+    async def get_download_status(self) -> List[Dict]:
+        """Get status of downloads in progress."""
+        return await self._call(self.client.get_download_status)
+
+    async def start_downloads(self) -> bool:
+        """Start/resume all downloads."""
+        return await self._call(self.client.start_downloads)
+
+    async def remove_links(self, link_uuids: List[int]) -> bool:
+        """Remove specific links by UUID."""
+        return await self._call(self.client.remove_links, link_uuids)
+
 
 # Singleton instance
 JD_CLIENT_INSTANCE: Optional[JDownloaderClient] = None
+ASYNC_JD_CLIENT_INSTANCE: Optional[AsyncJDClient] = None
 
 def get_jd_client() -> JDownloaderClient:
     """Get or create singleton JDownloaderClient instance."""
@@ -364,3 +469,10 @@ def get_jd_client() -> JDownloaderClient:
     if JD_CLIENT_INSTANCE is None:
         JD_CLIENT_INSTANCE = JDownloaderClient()
     return JD_CLIENT_INSTANCE
+
+def get_async_jd_client() -> AsyncJDClient:
+    """Get or create the singleton AsyncJDClient wrapping the shared client."""
+    global ASYNC_JD_CLIENT_INSTANCE  # pylint: disable=global-statement
+    if ASYNC_JD_CLIENT_INSTANCE is None:
+        ASYNC_JD_CLIENT_INSTANCE = AsyncJDClient(get_jd_client())
+    return ASYNC_JD_CLIENT_INSTANCE
@@ -1,4 +1,5 @@
 """Utility functions for Siphon Bot."""
+import functools
 import logging
 import math
 import os
@@ -25,28 +26,20 @@ def moon_progress_bar(percent: float, total_cells: int = 10) -> str:
     🌑 empty → 🌒 quarter → 🌓 half → 🌔 three-quarter → 🌕 full
     """
     percent = max(0, min(100, percent))
-    val = percent / 100 * total_cells
-    full_cells = int(val)
-    remainder = val - full_cells
+    # The bar only resolves quarter cells, so render (and cache) per quarter step
+    return _moon_bar(int(percent / 100 * total_cells * 4), total_cells)
+
+@functools.lru_cache(maxsize=256)
+def _moon_bar(quarters: int, total_cells: int) -> str:
+    full_cells, remainder = divmod(quarters, 4)
 
     # Select partial moon (Using Waning phases - Lit Left - as requested "reversed")
-    if remainder < 0.25:
-        partial = ""
-    elif remainder < 0.5:
-        partial = "🌘"  # Waning Crescent (Lit Left)
-    elif remainder < 0.75:
-        partial = "🌗"  # Last Quarter (Lit Left)
-    else:
-        partial = "🌖"  # Waning Gibbous (Lit Left)
+    # 🌘 Waning Crescent, 🌗 Last Quarter, 🌖 Waning Gibbous (all Lit Left)
+    partial = ("", "🌘", "🌗", "🌖")[remainder]
 
     # Construct bar
-    # If partial is empty but we have remainder, it means it's close to 0 but maybe
-    # should show something?
-    # Logic:
     # Full cells: 🌕
     # Current cell: partial or 🌑 (if very low) or 🌕 (if almost full? handled by int)
-
-    # Improved logic for partials:
     if full_cells >= total_cells:
         return "🌕" * total_cells
 
@@ -65,10 +58,19 @@ def moon_progress_bar(percent: float, total_cells: int = 10) -> str:
     # Return strictly 10 chars
     return res_bar[:total_cells]
 
+@functools.lru_cache(maxsize=64)
+def _cached_probe(file_path: str, _mtime_ns: int, _size: int) -> dict:
+    return ffmpeg.probe(file_path)
+
+def probe_file(file_path: str) -> dict:
+    """ffprobe a file, reusing the result until the file changes on disk."""
+    stat = os.stat(file_path)
+    return _cached_probe(file_path, stat.st_mtime_ns, stat.st_size)
+
 def get_video_metadata(file_path: str):
     """Get metadata and generate thumb."""
     try:
-        probe = ffmpeg.probe(file_path)
+        probe = probe_file(file_path)
         v_stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
         if not v_stream:
             return 0, 0, 0, None
@@ -83,6 +85,15 @@ def get_video_metadata(file_path: str):
         logger.warning("Metadata probe failed for %s: %s", file_path, err)
         return 0, 0, 0, None
 
+def get_video_duration(file_path: str) -> int:
+    """Get the container duration in seconds without generating a thumbnail."""
+    try:
+        probe = probe_file(file_path)
+        return int(float(probe['format'].get('duration', 0)))
+    except Exception as err:  # pylint: disable=broad-except
+        logger.warning("Duration probe failed for %s: %s", file_path, err)
+        return 0
+
 # Formats that support Telegram streaming
 STREAMING_FORMATS = ['.mp4', '.m4v', '.mov']
 # Codecs compatible with Telegram streaming
@@ -102,7 +113,7 @@ def needs_conversion(file_path: str) -> bool:
 
     # Check codecs
     try:
-        probe = ffmpeg.probe(file_path)
+        probe = probe_file(file_path)
         video_stream = next((s for s in probe['streams']
                              if s['codec_type'] == 'video'), None)
         audio_stream = next((s for s in probe['streams']
@@ -153,7 +164,7 @@ def convert_to_mp4(file_path: str, delete_original: bool = True) -> str:
 
     try:
         # Probe to check codecs
-        probe = ffmpeg.probe(file_path)
+        probe = probe_file(file_path)
         v_s = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
         a_s = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), None)
 
@@ -180,7 +191,12 @@ def convert_to_mp4(file_path: str, delete_original: bool = True) -> str:
         (ffmpeg.input(file_path).output(output_path, **o_args)
          .overwrite_output().run(capture_stdout=True, capture_stderr=True))
 
-        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        # One stat: a missing output raises instead of needing exists() first
+        try:
+            converted = os.path.getsize(output_path) > 0
+        except OSError:
+            converted = False
+        if converted:
             logger.info("✅ Conversion complete: %s", os.path.basename(output_path))
             if delete_original and file_path != output_path:
                 try:
@@ -199,9 +215,11 @@ def convert_to_mp4(file_path: str, delete_original: bool = True) -> str:
         logger.error("❌ Conversion error for %s: %s", file_path, err)
         return file_path
 
-def split_video(file_path: str, max_size_bytes: int = 2 * 1024 * 1024 * 1024) -> list:
+def split_video(file_path: str, max_size_bytes: int = 2 * 1024 * 1024 * 1024,
+                meta: tuple = None) -> list:
     """
     Split a video file into chunks smaller than max_size_bytes.
+    Pass meta (from get_video_metadata) to reuse an existing probe.
     Returns a list of file paths (the original if no split occurred, or parts).
     """
     if not os.path.exists(file_path):
@@ -216,9 +234,11 @@ def split_video(file_path: str, max_size_bytes: int = 2 * 1024 * 1024 * 1024) ->
 
     # Determine segment time based on average bitrate
     # Duration / (Size / MaxSize) = Time per chunk
-    meta = get_video_metadata(file_path)
-    # pylint: disable=invalid-name
-    _, _, duration, _ = meta
+    if meta is None:
+        # Only the duration is needed here, so don't render a thumbnail
+        duration = get_video_duration(file_path)
+    else:
+        duration = meta[2]
 
     if duration == 0:
         logger.warning("Could not determine duration, creating 1.9GB chunks.")